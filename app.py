@@ -1,16 +1,18 @@
 """
 Streamlit-based Claude Chat UI
-Stores conversations locally in JSON files
+Stores conversations locally in JSONL files
 Run: streamlit run app.py
 """
 
 import streamlit as st
 import os
-import json
+import time
 from datetime import datetime
-from pathlib import Path
 from anthropic import Anthropic
 from dotenv import load_dotenv
+import storage
+from pricing import calculate_cost
+from prompt_cache import with_cache_breakpoints
 
 # Load environment
 load_dotenv()
@@ -29,10 +31,6 @@ def get_client():
 
 client = get_client()
 
-# Storage directory
-STORAGE_DIR = Path("conversations")
-STORAGE_DIR.mkdir(exist_ok=True)
-
 # Available models
 MODELS = {
     "Claude Sonnet 4.5": "claude-sonnet-4-5-20250929",
@@ -40,76 +38,87 @@ MODELS = {
     "Claude Sonnet 4": "claude-sonnet-4-20250514",
 }
 
+# Built once instead of on every rerun
+MODEL_NAMES = list(MODELS)
+MODEL_INDEX = {name: i for i, name in enumerate(MODEL_NAMES)}
+
+# Streaming redraw throttle: seconds / new characters between placeholder updates
+RENDER_INTERVAL = 0.05
+RENDER_CHARS = 64
+
+# Conversations shown in the sidebar
+SIDEBAR_CONVERSATIONS = 10
+
+# Only the newest messages are rendered by default
+HISTORY_TAIL = 40
+# Assistant replies longer than this are cut, with a toggle for the rest
+COLLAPSE_CHARS = 20_000
+
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "api_messages" not in st.session_state:
+    st.session_state.api_messages = []
 if "conversation_id" not in st.session_state:
     st.session_state.conversation_id = None
 if "total_cost" not in st.session_state:
     st.session_state.total_cost = 0.0
 if "selected_model" not in st.session_state:
     st.session_state.selected_model = "Claude Sonnet 4.5"
+if "save_future" not in st.session_state:
+    st.session_state.save_future = None
 
 
-def save_conversation():
-    """Save current conversation to JSON file"""
+def save_conversation(new_messages, cost=0.0):
+    """Append the latest exchange to the current conversation file"""
     if not st.session_state.conversation_id:
         st.session_state.conversation_id = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    filename = STORAGE_DIR / f"{st.session_state.conversation_id}.json"
-    data = {
-        "id": st.session_state.conversation_id,
-        "created": datetime.now().isoformat(),
-        "model": st.session_state.selected_model,
-        "messages": st.session_state.messages,
-        "total_cost": st.session_state.total_cost
-    }
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=2)
+    # Written on the background thread so the next rerun doesn't wait on disk
+    future = storage.save_in_background(
+        st.session_state.conversation_id,
+        new_messages,
+        st.session_state.selected_model,
+        cost
+    )
+    # Appends don't touch the directory mtime, so drop the cached listing once written
+    future.add_done_callback(lambda _: _scan_conversations.clear())
+    st.session_state.save_future = future
 
 def load_conversation(conversation_id):
-    """Load conversation from JSON file"""
-    filename = STORAGE_DIR / f"{conversation_id}.json"
-    if filename.exists():
-        with open(filename, 'r') as f:
-            data = json.load(f)
-            st.session_state.messages = data.get("messages", [])
-            st.session_state.conversation_id = data.get("id")
-            st.session_state.total_cost = data.get("total_cost", 0.0)
-            st.session_state.selected_model = data.get("model", "Claude Sonnet 4.5")
+    """Load conversation into session state"""
+    data = storage.load_conversation(conversation_id)
+    if data:
+        st.session_state.messages = data.get("messages", [])
+        st.session_state.api_messages = storage.api_messages(st.session_state.messages)
+        st.session_state.conversation_id = data.get("id")
+        st.session_state.total_cost = data.get("total_cost", 0.0)
+        st.session_state.selected_model = data.get("model") or "Claude Sonnet 4.5"
+
+@st.cache_data(ttl=60)
+def _scan_conversations(dir_mtime):
+    """Scan the storage directory (cached per directory mtime)"""
+    return storage.list_conversations(preview_len=50, limit=SIDEBAR_CONVERSATIONS)
 
 def list_conversations():
     """List all saved conversations"""
-    conversations = []
-    for file in STORAGE_DIR.glob("*.json"):
-        with open(file, 'r') as f:
-            data = json.load(f)
-            # Get first user message as preview
-            preview = "New conversation"
-            for msg in data.get("messages", []):
-                if msg["role"] == "user":
-                    preview = msg["content"][:50] + "..." if len(msg["content"]) > 50 else msg["content"]
-                    break
-            conversations.append({
-                "id": data.get("id"),
-                "created": data.get("created"),
-                "preview": preview,
-                "cost": data.get("total_cost", 0.0)
-            })
-    return sorted(conversations, key=lambda x: x["created"], reverse=True)
-
-def calculate_cost(input_tokens, output_tokens, model):
-    """Calculate cost based on model pricing"""
-    # Pricing per million tokens
-    pricing = {
-        "claude-sonnet-4-5-20250929": (3, 15),
-        "claude-opus-4-20250514": (15, 75),
-        "claude-sonnet-4-20250514": (3, 15),
-    }
-
-    input_cost, output_cost = pricing.get(model, (3, 15))
-    cost = (input_tokens * input_cost / 1_000_000) + (output_tokens * output_cost / 1_000_000)
-    return cost
+    return _scan_conversations(storage.STORAGE_DIR.stat().st_mtime)
+
+def render_message(message, idx):
+    """Render one chat message, collapsing very long assistant replies"""
+    content = message.content
+    with st.chat_message(message.role):
+        if message.role != "assistant" or len(content) <= COLLAPSE_CHARS:
+            st.markdown(content)
+            return
+        # Cut at a line break so markdown blocks mostly stay intact
+        cut = content.rfind("\n", 0, COLLAPSE_CHARS)
+        if cut <= 0:
+            cut = COLLAPSE_CHARS
+        if st.toggle("Show full reply", key=f"expand_{idx}"):
+            st.markdown(content)
+        else:
+            st.markdown(content[:cut] + "\n\n…")
 
 # Sidebar
 with st.sidebar:
@@ -118,8 +127,9 @@ with st.sidebar:
     # Model selection
     st.session_state.selected_model = st.selectbox(
         "Model",
-        options=list(MODELS.keys()),
-        index=list(MODELS.keys()).index(st.session_state.selected_model)
+        options=MODEL_NAMES,
+        # Conversations saved with a retired model fall back to the first one
+        index=MODEL_INDEX.get(st.session_state.selected_model, 0)
     )
 
     st.divider()
@@ -127,6 +137,7 @@ with st.sidebar:
     # New conversation button
     if st.button("➕ New Conversation", use_container_width=True):
         st.session_state.messages = []
+        st.session_state.api_messages = []
         st.session_state.conversation_id = None
         st.session_state.total_cost = 0.0
         st.rerun()
@@ -138,7 +149,7 @@ with st.sidebar:
     conversations = list_conversations()
 
     if conversations:
-        for conv in conversations[:10]:  # Show last 10
+        for conv in conversations:  # Most recently active SIDEBAR_CONVERSATIONS only
             col1, col2 = st.columns([4, 1])
             with col1:
                 if st.button(
@@ -158,20 +169,32 @@ with st.sidebar:
     # Stats
     st.subheader("📊 Session Stats")
     st.metric("Total Cost", f"${st.session_state.total_cost:.4f}")
-    st.metric("Messages", len([m for m in st.session_state.messages if m["role"] == "user"]))
+    st.metric("Messages", len([m for m in st.session_state.messages if m.role == "user"]))
 
 # Main chat interface
 st.title("🤖 Claude Chat Interface")
 
-# Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+# Report a background save that failed since the last rerun
+save_future = st.session_state.save_future
+if save_future is not None and save_future.done():
+    if save_future.exception():
+        st.error(f"Save failed: {save_future.exception()}")
+    st.session_state.save_future = None
+
+# Display chat messages (older ones only on request, so reruns stay cheap)
+messages = st.session_state.messages
+tail_start = max(len(messages) - HISTORY_TAIL, 0)
+if tail_start and st.toggle(f"Show {tail_start} earlier messages", key="show_earlier"):
+    for idx in range(tail_start):
+        render_message(messages[idx], idx)
+for idx in range(tail_start, len(messages)):
+    render_message(messages[idx], idx)
 
 # Chat input
 if prompt := st.chat_input("Message Claude..."):
     # Add user message
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    st.session_state.messages.append(storage.Message("user", prompt))
+    st.session_state.api_messages.append({"role": "user", "content": prompt})
 
     with st.chat_message("user"):
         st.markdown(prompt)
@@ -182,45 +205,53 @@ if prompt := st.chat_input("Message Claude..."):
         full_response = ""
 
         try:
-            # Prepare messages for API
-            api_messages = [
-                {"role": m["role"], "content": m["content"]}
-                for m in st.session_state.messages
-            ]
-
             # Stream response
             with client.messages.stream(
                 model=MODELS[st.session_state.selected_model],
                 max_tokens=8000,
-                messages=api_messages
+                messages=with_cache_breakpoints(st.session_state.api_messages)
             ) as stream:
+                last_render = time.monotonic()
+                last_render_len = 0
                 for text in stream.text_stream:
                     full_response += text
-                    message_placeholder.markdown(full_response + "▌")
+                    now = time.monotonic()
+                    if now - last_render > RENDER_INTERVAL or len(full_response) - last_render_len > RENDER_CHARS:
+                        message_placeholder.markdown(full_response + "▌")
+                        last_render = now
+                        last_render_len = len(full_response)
 
                 message_placeholder.markdown(full_response)
 
                 # Get usage stats
                 final_message = stream.get_final_message()
-                input_tokens = final_message.usage.input_tokens
-                output_tokens = final_message.usage.output_tokens
+                usage = final_message.usage
+                input_tokens = usage.input_tokens
+                output_tokens = usage.output_tokens
+                cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+                cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
 
                 # Calculate cost
                 cost = calculate_cost(
                     input_tokens,
                     output_tokens,
-                    MODELS[st.session_state.selected_model]
+                    MODELS[st.session_state.selected_model],
+                    cache_write_tokens,
+                    cache_read_tokens
                 )
                 st.session_state.total_cost += cost
 
                 # Show stats
-                st.caption(f"Tokens: {input_tokens} in / {output_tokens} out | Cost: ${cost:.4f}")
+                total_in = input_tokens + cache_write_tokens + cache_read_tokens
+                cached = f" ({cache_read_tokens} cached)" if cache_read_tokens else ""
+                st.caption(f"Tokens: {total_in} in{cached} / {output_tokens} out | Cost: ${cost:.4f}")
 
             # Add assistant response
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
+            st.session_state.messages.append(storage.Message("assistant", full_response))
+            st.session_state.api_messages.append({"role": "assistant", "content": full_response})
 
-            # Save conversation
-            save_conversation()
+            # Save conversation (appends only the new turn)
+            save_conversation(st.session_state.messages[-2:], cost)
 
         except Exception as e:
             st.error(f"Error: {str(e)}")
@@ -1,17 +1,19 @@
 """
 Terminal-based Claude Chat Interface
-Stores conversations locally in JSON files
+Stores conversations locally in JSONL files
 Features: conversation history, cost tracking, model selection, streaming
 Run: python claude_cli.py
 """
 
+import codecs
 import os
-import json
 import sys
 from datetime import datetime
-from pathlib import Path
 from anthropic import Anthropic
 from dotenv import load_dotenv
+from storage import ConversationWriter, Message, api_messages, load_conversation, list_conversations
+from pricing import calculate_cost
+from prompt_cache import with_cache_breakpoints
 
 # Load environment
 load_dotenv()
@@ -19,10 +21,6 @@ load_dotenv()
 # Initialize Anthropic client
 client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
-# Storage directory
-STORAGE_DIR = Path("conversations")
-STORAGE_DIR.mkdir(exist_ok=True)
-
 # Available models
 MODELS = {
     "1": ("Claude Sonnet 4.5", "claude-sonnet-4-5-20250929"),
@@ -30,6 +28,10 @@ MODELS = {
     "3": ("Claude Sonnet 4", "claude-sonnet-4-20250514"),
 }
 
+# Model ID by display name, for resuming saved conversations
+MODELS_BY_NAME = {name: mid for _, (name, mid) in MODELS.items()}
+DEFAULT_MODEL_ID = MODELS["1"][1]
+
 # ANSI color codes
 class Colors:
     HEADER = '\033[95m'
@@ -52,61 +54,10 @@ def print_header():
     print_colored("         🤖 CLAUDE CLI CHAT INTERFACE", Colors.BOLD + Colors.CYAN)
     print_colored("="*60 + "\n", Colors.CYAN)
 
-def calculate_cost(input_tokens, output_tokens, model):
-    """Calculate cost based on model pricing"""
-    # Pricing per million tokens
-    pricing = {
-        "claude-sonnet-4-5-20250929": (3, 15),
-        "claude-opus-4-20250514": (15, 75),
-        "claude-sonnet-4-20250514": (3, 15),
-    }
-
-    input_cost, output_cost = pricing.get(model, (3, 15))
-    cost = (input_tokens * input_cost / 1_000_000) + (output_tokens * output_cost / 1_000_000)
-    return cost
-
-def save_conversation(conversation_id, messages, model_name, total_cost):
-    """Save conversation to JSON file"""
-    filename = STORAGE_DIR / f"{conversation_id}.json"
-    data = {
-        "id": conversation_id,
-        "created": datetime.now().isoformat(),
-        "model": model_name,
-        "messages": messages,
-        "total_cost": total_cost
-    }
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=2)
-
-def load_conversation(conversation_id):
-    """Load conversation from JSON file"""
-    filename = STORAGE_DIR / f"{conversation_id}.json"
-    if filename.exists():
-        with open(filename, 'r') as f:
-            data = json.load(f)
-            return data
-    return None
-
-def list_conversations():
-    """List all saved conversations"""
-    conversations = []
-    for file in STORAGE_DIR.glob("*.json"):
-        with open(file, 'r') as f:
-            data = json.load(f)
-            # Get first user message as preview
-            preview = "New conversation"
-            for msg in data.get("messages", []):
-                if msg["role"] == "user":
-                    preview = msg["content"][:60] + "..." if len(msg["content"]) > 60 else msg["content"]
-                    break
-            conversations.append({
-                "id": data.get("id"),
-                "created": data.get("created"),
-                "preview": preview,
-                "cost": data.get("total_cost", 0.0),
-                "model": data.get("model", "Unknown")
-            })
-    return sorted(conversations, key=lambda x: x["created"], reverse=True)
+def report_save_error(future):
+    """Report a background save that failed"""
+    if future.exception():
+        print_colored(f"\n❌ Save failed: {future.exception()}", Colors.RED)
 
 def select_model():
     """Let user select a model"""
@@ -137,6 +88,11 @@ def chat_loop(messages, model_id, model_name, conversation_id, total_cost):
     print_colored("Commands: 'exit' to quit, 'save' to save and quit, 'clear' to clear screen", Colors.YELLOW)
     print_colored("For multi-line input, end with '###' on a new line\n", Colors.YELLOW)
 
+    # One append handle for the whole session, closed when the loop ends
+    writer = ConversationWriter(conversation_id)
+    # Plain dicts for the API, kept in step with messages
+    history = api_messages(messages)
+
     while True:
         # Get user input
         try:
@@ -148,12 +104,12 @@ def chat_loop(messages, model_id, model_name, conversation_id, total_cost):
             if first_line.lower() == 'exit':
                 choice = input(f"{Colors.YELLOW}Save before exiting? (y/n): {Colors.RESET}").strip().lower()
                 if choice == 'y':
-                    save_conversation(conversation_id, messages, model_name, total_cost)
+                    writer.write([], model_name)
                     print_colored("💾 Conversation saved!", Colors.GREEN)
                 break
 
             if first_line.lower() == 'save':
-                save_conversation(conversation_id, messages, model_name, total_cost)
+                writer.write([], model_name)
                 print_colored("💾 Conversation saved!", Colors.GREEN)
                 break
 
@@ -178,58 +134,77 @@ def chat_loop(messages, model_id, model_name, conversation_id, total_cost):
                 continue
 
             # Add to messages
-            messages.append({"role": "user", "content": user_input})
+            messages.append(Message("user", user_input))
+            history.append({"role": "user", "content": user_input})
 
             # Get Claude response
             print_colored("\nClaude:", Colors.BOLD + Colors.GREEN)
 
             try:
-                full_response = ""
+                buf = bytearray()
+                out = sys.stdout.buffer
+                encoding = sys.stdout.encoding
+                # Reuse the UTF-8 bytes for the console when it is UTF-8 too
+                utf8_console = codecs.lookup(encoding).name == 'utf-8'
+                sys.stdout.flush()  # Header went through the text layer
 
                 # Stream response
                 with client.messages.stream(
                     model=model_id,
                     max_tokens=8000,
-                    messages=messages
+                    messages=with_cache_breakpoints(history)
                 ) as stream:
                     for text in stream.text_stream:
-                        print(text, end='', flush=True)
-                        full_response += text
+                        data = text.encode('utf-8')
+                        buf.extend(data)
+                        out.write(data if utf8_console else text.encode(encoding, errors='replace'))
+                        out.flush()
+                    full_response = buf.decode('utf-8')
 
                     print()  # New line after response
 
                     # Get usage stats
                     final_message = stream.get_final_message()
-                    input_tokens = final_message.usage.input_tokens
-                    output_tokens = final_message.usage.output_tokens
+                    usage = final_message.usage
+                    input_tokens = usage.input_tokens
+                    output_tokens = usage.output_tokens
+                    cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+                    cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
 
                     # Calculate cost
-                    cost = calculate_cost(input_tokens, output_tokens, model_id)
+                    cost = calculate_cost(input_tokens, output_tokens, model_id, cache_write_tokens, cache_read_tokens)
                     total_cost += cost
 
                     # Show stats
-                    print_colored(f"\n📊 Tokens: {input_tokens} in / {output_tokens} out | Cost: ${cost:.4f} | Total: ${total_cost:.4f}", Colors.CYAN)
+                    total_in = input_tokens + cache_write_tokens + cache_read_tokens
+                    cached = f" ({cache_read_tokens} cached)" if cache_read_tokens else ""
+                    print_colored(f"\n📊 Tokens: {total_in} in{cached} / {output_tokens} out | Cost: ${cost:.4f} | Total: ${total_cost:.4f}", Colors.CYAN)
 
                 # Add assistant response
-                messages.append({"role": "assistant", "content": full_response})
+                messages.append(Message("assistant", full_response))
+                history.append({"role": "assistant", "content": full_response})
 
-                # Auto-save after each exchange
-                save_conversation(conversation_id, messages, model_name, total_cost)
+                # Auto-save after each exchange (appends only the new turn),
+                # in the background so the next prompt doesn't wait on disk
+                writer.submit(messages[-2:], model_name, cost).add_done_callback(report_save_error)
 
             except Exception as e:
                 print_colored(f"\n❌ Error: {str(e)}", Colors.RED)
                 messages.pop()  # Remove user message if failed
+                history.pop()
 
         except KeyboardInterrupt:
             print_colored("\n\n⚠️  Interrupted. Save conversation? (y/n): ", Colors.YELLOW)
             choice = input().strip().lower()
             if choice == 'y':
-                save_conversation(conversation_id, messages, model_name, total_cost)
+                writer.write([], model_name)
                 print_colored("💾 Conversation saved!", Colors.GREEN)
             break
         except EOFError:
             break
 
+    writer.close()
+
 def main():
     """Main function"""
     print_header()
@@ -253,15 +228,14 @@ def main():
 
         elif choice == "2":
             # Load conversation
-            conversations = list_conversations()
+            conversations = list_conversations(preview_len=60, limit=20)
             if not conversations:
                 print_colored("\n❌ No saved conversations found.", Colors.RED)
                 continue
 
             print_colored("\n💾 Saved Conversations:", Colors.CYAN)
             for i, conv in enumerate(conversations[:20], 1):
-                created = datetime.fromisoformat(conv['created']).strftime("%Y-%m-%d %H:%M")
-                print(f"  {i}. [{created}] {conv['preview']} (${conv['cost']:.4f})")
+                print(f"  {i}. [{conv['created_display']}] {conv['preview']} (${conv['cost']:.4f})")
 
             choice_idx = input(f"\n{Colors.GREEN}Select conversation (1-{len(conversations[:20])}): {Colors.RESET}").strip()
             try:
@@ -270,15 +244,8 @@ def main():
                     conv_data = load_conversation(conversations[idx]['id'])
                     if conv_data:
                         print_colored(f"\n✅ Loaded: {conversations[idx]['preview']}", Colors.GREEN)
-                        model_name = conv_data.get('model', 'Claude Sonnet 4.5')
-                        # Find model ID from name
-                        model_id = None
-                        for _, (name, mid) in MODELS.items():
-                            if name == model_name:
-                                model_id = mid
-                                break
-                        if not model_id:
-                            model_id = MODELS["1"][1]
+                        model_name = conv_data.get('model') or 'Claude Sonnet 4.5'
+                        model_id = MODELS_BY_NAME.get(model_name, DEFAULT_MODEL_ID)
 
                         chat_loop(
                             conv_data['messages'],
@@ -294,7 +261,7 @@ def main():
 
         elif choice == "3":
             # List conversations
-            conversations = list_conversations()
+            conversations = list_conversations(preview_len=60)
             if not conversations:
                 print_colored("\n❌ No saved conversations found.", Colors.RED)
                 continue
@@ -304,8 +271,7 @@ def main():
             print_colored(f"💰 Total Cost: ${total_cost:.4f}\n", Colors.CYAN)
 
             for i, conv in enumerate(conversations[:20], 1):
-                created = datetime.fromisoformat(conv['created']).strftime("%Y-%m-%d %H:%M")
-                print(f"  {i}. [{created}] {conv['model']}")
+                print(f"  {i}. [{conv['created_display']}] {conv['model']}")
                 print(f"     {conv['preview']}")
                 print(f"     Cost: ${conv['cost']:.4f}\n")
 
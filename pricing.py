@@ -0,0 +1,29 @@
+"""
+Model pricing shared by the CLI and Streamlit UI
+Rates are stored per token (USD per million tokens / 1,000,000)
+"""
+
+# (input, output) cost per token
+PRICING = {
+    "claude-sonnet-4-5-20250929": (3e-6, 15e-6),
+    "claude-opus-4-20250514": (15e-6, 75e-6),
+    "claude-sonnet-4-20250514": (3e-6, 15e-6),
+}
+
+# Used for model IDs missing from the table
+DEFAULT_PRICING = (3e-6, 15e-6)
+
+# Prompt cache writes and reads, as multiples of the input rate
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+
+
+def calculate_cost(input_tokens, output_tokens, model, cache_write_tokens=0, cache_read_tokens=0):
+    """Calculate cost based on model pricing, including prompt cache traffic"""
+    input_rate, output_rate = PRICING.get(model, DEFAULT_PRICING)
+    return (
+        input_tokens * input_rate
+        + cache_write_tokens * input_rate * CACHE_WRITE_MULTIPLIER
+        + cache_read_tokens * input_rate * CACHE_READ_MULTIPLIER
+        + output_tokens * output_rate
+    )
@@ -0,0 +1,41 @@
+"""
+Prompt caching helpers shared by the CLI and Streamlit UI
+Marks cache breakpoints so the API can reuse the already-processed history
+instead of reprocessing the whole conversation every turn
+"""
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Extra breakpoint every N messages, keeping long histories inside the
+# API's cache lookback window
+CACHE_INTERVAL = 16
+
+
+def _with_breakpoint(msg):
+    """Copy of a message with cache_control on its last content block"""
+    content = msg["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = list(content)
+    content[-1] = dict(content[-1], cache_control=CACHE_CONTROL)
+    return {"role": msg["role"], "content": content}
+
+def with_cache_breakpoints(messages):
+    """Messages for the API with breakpoints on the newest and a periodic anchor
+
+    Only the marked messages are copied; the stored history is untouched.
+    """
+    if not messages:
+        return messages
+    marked = list(messages)
+    last = len(marked) - 1
+    breakpoints = {last}
+    anchor = last // CACHE_INTERVAL * CACHE_INTERVAL
+    if anchor:  # Index 0 would only cache the opening message
+        breakpoints.add(anchor)
+    for idx in breakpoints:
+        # Empty text blocks are rejected by the API
+        if marked[idx]["content"]:
+            marked[idx] = _with_breakpoint(marked[idx])
+    return marked
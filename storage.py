@@ -0,0 +1,493 @@
+"""
+Conversation storage shared by the CLI and Streamlit UI
+Each conversation is an append-only JSONL file: one session_metadata line,
+then one line per message and one cost_update line per exchange
+Legacy monolithic .json conversations are still readable
+A sidecar _index.jsonl keeps one row per conversation for fast listing
+Very large or base64-heavy message contents live in blobs/ and are
+referenced from the JSONL file as {"ref": "blob:<sha1>", "len": N}
+Messages and records are msgspec Structs, encoded/decoded by msgspec.json
+"""
+
+import functools
+import hashlib
+import heapq
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Union
+import msgspec
+
+# Storage directory
+STORAGE_DIR = Path("conversations")
+STORAGE_DIR.mkdir(exist_ok=True)
+
+# Sidecar index: append-only, later rows for the same id win
+INDEX_FILE = STORAGE_DIR / "_index.jsonl"
+
+# Externalized message contents, named by SHA-1
+BLOB_DIR = STORAGE_DIR / "blobs"
+
+# Message contents above this size are stored as blobs
+BLOB_THRESHOLD = 32 * 1024
+
+# Inline data URLs / long base64 runs are stored as blobs regardless of size
+_INLINE_DATA_RE = re.compile(r"data:[\w.+-]+/[\w.+-]+;base64,[A-Za-z0-9+/=]{256}|[A-Za-z0-9+/]{1024}")
+
+# Buffer size for appends
+WRITE_BUFFER = 1 << 16
+
+# Threads used when rebuilding the index
+SCAN_WORKERS = 8
+
+# Background writer: a single thread, so saves land in submission order
+_SAVE_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save")
+
+# Serializes conversation/index writes between the pool and direct callers
+_WRITE_LOCK = threading.Lock()
+
+# Characters of the first user message kept in the index
+PREVIEW_CHARS = 100
+
+# Every message record starts with these bytes (msgspec writes the tag first)
+_MESSAGE_PREFIX = b'{"type":"message"'
+
+
+class Message(msgspec.Struct, frozen=True, gc=False):
+    """One chat message, as held in memory by both front ends"""
+    role: str
+    content: str
+
+class _BlobRef(msgspec.Struct):
+    ref: str
+    len: int
+
+class _SessionMetadata(msgspec.Struct, tag="session_metadata", tag_field="type"):
+    id: str
+    model: Optional[str] = None
+    created: Optional[str] = None
+
+class _MessageRecord(msgspec.Struct, tag="message", tag_field="type"):
+    role: str
+    content: Union[str, _BlobRef]
+
+class _CostUpdate(msgspec.Struct, tag="cost_update", tag_field="type"):
+    delta: float = 0.0
+    model: Optional[str] = None
+
+_ENCODER = msgspec.json.Encoder()
+_RECORD_DECODER = msgspec.json.Decoder(Union[_SessionMetadata, _MessageRecord, _CostUpdate])
+
+
+def conversation_path(conversation_id):
+    """Path of the JSONL file for a conversation"""
+    return STORAGE_DIR / f"{conversation_id}.jsonl"
+
+def legacy_path(conversation_id):
+    """Path of the pre-JSONL monolithic file for a conversation"""
+    return STORAGE_DIR / f"{conversation_id}.json"
+
+def _records(objs):
+    """Serialize compact JSONL records into one buffer"""
+    buf = bytearray()
+    for obj in objs:
+        # Encode straight onto the end of the buffer, no per-record bytes
+        _ENCODER.encode_into(obj, buf, -1)
+        buf.extend(b"\n")
+    return buf
+
+def _record(obj):
+    """Serialize one compact JSONL record"""
+    return _records((obj,))
+
+def _lines(f):
+    """Non-blank lines of a JSONL file, each paired with whether it is the last"""
+    prev = None
+    for line in f:
+        if not line.strip():
+            continue
+        if prev is not None:
+            yield prev, False
+        prev = line
+    if prev is not None:
+        yield prev, True
+
+def _decode_record(line, last):
+    """Decode one record, or None for a torn final append"""
+    try:
+        return _RECORD_DECODER.decode(line)
+    except msgspec.DecodeError:
+        # A crash mid-append leaves a partial, unterminated last line
+        if last or not line.endswith(b"\n"):
+            return None
+        raise
+
+def _repair_tail(filename):
+    """Make sure new appends start on a fresh line after the last record
+
+    An unterminated final line is kept (and terminated) if it decodes, the
+    same as _decode_record would read it, and cut off if it is torn.
+    """
+    with open(filename, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        if not end:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b"\n":
+            return
+        # Walk back to the start of the unterminated line
+        start = 0
+        pos = end
+        while pos > 0:
+            block = max(pos - WRITE_BUFFER, 0)
+            f.seek(block)
+            newline = f.read(pos - block).rfind(b"\n")
+            if newline != -1:
+                start = block + newline + 1
+                break
+            pos = block
+        f.seek(start)
+        fragment = f.read()
+        if fragment.strip() and _decode_record(fragment, True) is not None:
+            f.write(b"\n")
+        else:
+            f.truncate(start)
+
+def _metadata(conversation_id, model_name, created=None):
+    return _SessionMetadata(conversation_id, model_name, created or datetime.now().isoformat())
+
+def _externalize(content):
+    """Move large or base64-heavy content to a blob, returning a reference"""
+    if len(content) <= BLOB_THRESHOLD and not _INLINE_DATA_RE.search(content):
+        return content
+    data = content.encode('utf-8')
+    digest = hashlib.sha1(data).hexdigest()
+    blob = BLOB_DIR / f"{digest}.bin"
+    # Content-addressed, so an existing blob is already correct
+    if not blob.exists():
+        BLOB_DIR.mkdir(exist_ok=True)
+        tmp = blob.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, blob)
+    return _BlobRef(f"blob:{digest}", len(data))
+
+def _blob_path(ref):
+    return BLOB_DIR / f"{ref.ref[len('blob:'):]}.bin"
+
+def _resolve(content, limit=None):
+    """Content of a message record, reading blob references from disk"""
+    if not isinstance(content, _BlobRef):
+        return content if limit is None else content[:limit]
+    try:
+        with open(_blob_path(content), 'rb') as f:
+            # A limited read may end mid-character; drop the partial tail
+            data = f.read() if limit is None else f.read(limit * 4)
+    except FileNotFoundError:
+        return f"[missing attachment {content.ref}]"
+    text = data.decode('utf-8', errors='ignore')
+    return text if limit is None else text[:limit]
+
+def _message_record(msg):
+    return _MessageRecord(msg.role, _externalize(msg.content))
+
+def _migrate_legacy(conversation_id):
+    """Rewrite a legacy .json conversation as JSONL so it can be appended to"""
+    old = legacy_path(conversation_id)
+    data = _load_legacy(old)
+    records = [_metadata(data.get("id", conversation_id), data.get("model"), data.get("created"))]
+    records.extend(_message_record(msg) for msg in data.get("messages", []))
+    records.append(_CostUpdate(data.get("total_cost", 0.0), data.get("model")))
+    with open(conversation_path(conversation_id), 'wb', buffering=WRITE_BUFFER) as f:
+        f.write(_records(records))
+    old.unlink()
+
+def _exchange_records(new_messages, model_name, cost_delta):
+    """All records for one exchange, encoded for a single write()"""
+    records = [_message_record(msg) for msg in new_messages]
+    records.append(_CostUpdate(cost_delta, model_name))
+    return _records(records)
+
+def _prepare(conversation_id, model_name):
+    """Make sure the conversation file and its index row exist"""
+    rows = _read_index()
+    filename = conversation_path(conversation_id)
+    if filename.exists():
+        _repair_tail(filename)
+    # Left empty when its only line was a torn metadata record; start it over
+    if not filename.exists() or not filename.stat().st_size:
+        if legacy_path(conversation_id).exists():
+            _migrate_legacy(conversation_id)
+        else:
+            with open(filename, 'wb') as f:
+                f.write(_record(_metadata(conversation_id, model_name)))
+    if conversation_id not in rows:
+        _update_index(_scan_entry(filename), rows)
+    return rows
+
+def _record_exchange(rows, conversation_id, new_messages, model_name, cost_delta):
+    """Fold an appended exchange into the conversation's index row"""
+    entry = dict(rows[conversation_id], model=model_name, updated=datetime.now().isoformat())
+    entry["cost"] += cost_delta
+    if not entry["preview"]:
+        entry["preview"] = _first_user_text(new_messages)
+    _update_index(entry, rows)
+
+def save_conversation(conversation_id, new_messages, model_name, cost_delta=0.0):
+    """Append new messages and their cost to the conversation file"""
+    with _WRITE_LOCK:
+        rows = _prepare(conversation_id, model_name)
+        if not new_messages and not cost_delta:
+            return
+
+        with open(conversation_path(conversation_id), 'ab', buffering=WRITE_BUFFER) as f:
+            f.write(_exchange_records(new_messages, model_name, cost_delta))
+        _record_exchange(rows, conversation_id, new_messages, model_name, cost_delta)
+
+def save_in_background(conversation_id, new_messages, model_name, cost_delta=0.0):
+    """Queue save_conversation on the background writer, returning its future"""
+    return _SAVE_POOL.submit(save_conversation, conversation_id, list(new_messages), model_name, cost_delta)
+
+def wait_for_saves():
+    """Block until every queued background save has finished"""
+    _SAVE_POOL.submit(lambda: None).result()
+
+class ConversationWriter:
+    """Append handle kept open across the turns of a chat session"""
+
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+        self._file = None
+        self._rows = None
+
+    def write(self, new_messages, model_name, cost_delta=0.0):
+        """Append new messages and their cost, flushing once per call"""
+        with _WRITE_LOCK:
+            if self._file is None:
+                # Opened lazily so an unused session leaves no file behind
+                self._rows = _prepare(self.conversation_id, model_name)
+                self._file = open(conversation_path(self.conversation_id), 'ab', buffering=WRITE_BUFFER)
+            if not new_messages and not cost_delta:
+                return
+
+            self._file.write(_exchange_records(new_messages, model_name, cost_delta))
+            self._file.flush()
+            _record_exchange(self._rows, self.conversation_id, new_messages, model_name, cost_delta)
+
+    def submit(self, new_messages, model_name, cost_delta=0.0):
+        """Queue write() on the background writer, returning its future"""
+        return _SAVE_POOL.submit(self.write, list(new_messages), model_name, cost_delta)
+
+    def close(self):
+        """Wait for queued writes, then flush and close the append handle"""
+        wait_for_saves()
+        with _WRITE_LOCK:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def _first_user_text(messages):
+    """First user message, cut to what the index keeps"""
+    for msg in messages:
+        if msg.role == "user":
+            return msg.content[:PREVIEW_CHARS]
+    return ""
+
+def _display_time(created):
+    """Timestamp as shown in conversation lists"""
+    return datetime.fromisoformat(created).strftime("%Y-%m-%d %H:%M") if created else ""
+
+def _modified_time(filename):
+    """File mtime in the same ISO form as created/updated"""
+    return datetime.fromtimestamp(filename.stat().st_mtime).isoformat()
+
+def _index_entry(data, updated=None):
+    """Index row for a loaded conversation"""
+    return {
+        "id": data.get("id"),
+        "created": data.get("created"),
+        "created_display": _display_time(data.get("created")),
+        "updated": updated or data.get("created"),
+        "preview": _first_user_text(data.get("messages", [])),
+        "cost": data.get("total_cost", 0.0),
+        "model": data.get("model") or "Unknown",
+    }
+
+def _scan_entry(filename):
+    """Index row for a conversation file, decoding only what the row needs"""
+    if filename.suffix != ".jsonl":
+        return _index_entry(_load_legacy(filename), _modified_time(filename))
+
+    entry = {"id": None, "created": None, "preview": "", "cost": 0.0, "model": None}
+    with open(filename, 'rb') as f:
+        for line, last in _lines(f):
+            # Once the preview is known, message lines are skipped undecoded
+            if entry["preview"] and line.startswith(_MESSAGE_PREFIX):
+                continue
+            record = _decode_record(line, last)
+            if record is None:
+                continue
+            if isinstance(record, _MessageRecord):
+                if record.role == "user":
+                    entry["preview"] = _resolve(record.content, PREVIEW_CHARS)
+            elif isinstance(record, _CostUpdate):
+                entry["cost"] += record.delta
+                entry["model"] = record.model or entry["model"]
+            else:
+                entry["id"] = record.id
+                entry["created"] = record.created
+                entry["model"] = entry["model"] or record.model
+    # The metadata line may have been torn; the file is named after the id
+    entry["id"] = entry["id"] or filename.stem
+    entry["model"] = entry["model"] or "Unknown"
+    entry["created_display"] = _display_time(entry["created"])
+    # Last activity is the last append, which is when the file was modified
+    entry["updated"] = _modified_time(filename)
+    return entry
+
+def _conversation_files():
+    """All conversation files, skipping the index and other sidecars"""
+    # One directory pass instead of a glob per extension
+    with os.scandir(STORAGE_DIR) as entries:
+        return [
+            Path(entry.path) for entry in entries
+            if entry.name.endswith((".jsonl", ".json"))
+            and not entry.name.startswith("_")
+            and entry.is_file()
+        ]
+
+def _write_index(rows):
+    """Atomically replace the index with one row per conversation"""
+    tmp = INDEX_FILE.with_suffix(".jsonl.tmp")
+    with open(tmp, 'wb', buffering=WRITE_BUFFER) as f:
+        f.write(_records(rows.values()))
+    os.replace(tmp, INDEX_FILE)
+
+def _rebuild_index():
+    """Scan every conversation file once and write a fresh index"""
+    rows = {}
+    # File reads release the GIL, so scan files concurrently
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as ex:
+        for entry in ex.map(_scan_entry, _conversation_files()):
+            rows[entry["id"]] = entry
+    _write_index(rows)
+    return rows
+
+def _read_index():
+    """Read the index into {id: row}, rebuilding it if missing"""
+    if not INDEX_FILE.exists():
+        return _rebuild_index()
+    rows = {}
+    lines = 0
+    stale = False
+    with open(INDEX_FILE, 'rb') as f:
+        for line, last in _lines(f):
+            try:
+                row = msgspec.json.decode(line)
+            except msgspec.DecodeError:
+                # Partial row from an interrupted append; the rewrite below drops it
+                if last or not line.endswith(b"\n"):
+                    stale = True
+                    continue
+                raise
+            # Rows scanned from a file with a torn metadata line had no id
+            if row.get("id") is None:
+                stale = True
+                continue
+            rows[row["id"]] = row
+            lines += 1
+    # Fold superseded rows away once they outnumber the live ones
+    if stale or lines > 2 * len(rows):
+        _write_index(rows)
+    return rows
+
+def _update_index(entry, rows):
+    """Record the latest row for a conversation"""
+    rows[entry["id"]] = entry
+    with open(INDEX_FILE, 'ab') as f:
+        f.write(_record(entry))
+
+def _load_legacy(filename):
+    """Load a pre-JSONL conversation file"""
+    with open(filename, 'rb') as f:
+        data = msgspec.json.decode(f.read())
+    data["messages"] = msgspec.convert(data.get("messages", []), List[Message])
+    return data
+
+def _load_jsonl(filename):
+    """Fold a JSONL conversation file into a conversation dict"""
+    data = {"id": None, "created": None, "model": None, "messages": [], "total_cost": 0.0}
+    with open(filename, 'rb') as f:
+        for line, last in _lines(f):
+            record = _decode_record(line, last)
+            if record is None:
+                continue
+            if isinstance(record, _MessageRecord):
+                data["messages"].append(Message(record.role, _resolve(record.content)))
+            elif isinstance(record, _CostUpdate):
+                data["total_cost"] += record.delta
+                data["model"] = record.model or data["model"]
+            else:
+                data["id"] = record.id
+                data["created"] = record.created
+                data["model"] = data["model"] or record.model
+    return data
+
+@functools.lru_cache(maxsize=64)
+def _load_from_disk(path_str, mtime_ns, size):
+    """Parse a conversation file once per (path, mtime, size)
+
+    Messages come back as a tuple of frozen Message structs so the cached
+    value can't be mutated by callers.
+    """
+    filename = Path(path_str)
+    data = _load_jsonl(filename) if filename.suffix == ".jsonl" else _load_legacy(filename)
+    return dict(data, messages=tuple(data.get("messages", ())))
+
+def load_conversation(conversation_id):
+    """Load conversation from its JSONL file, falling back to legacy JSON"""
+    # A save still queued for this conversation must land first
+    wait_for_saves()
+    for filename in (conversation_path(conversation_id), legacy_path(conversation_id)):
+        try:
+            info = filename.stat()
+        except FileNotFoundError:
+            continue
+        data = _load_from_disk(str(filename), info.st_mtime_ns, info.st_size)
+        # A fresh list, since both front ends append to it
+        return dict(data, messages=list(data["messages"]))
+    return None
+
+def api_messages(messages):
+    """Plain role/content dicts for the Anthropic API"""
+    return msgspec.to_builtins(messages)
+
+def _last_active(row):
+    # Rows written before updated existed fall back to created
+    return row.get("updated") or row["created"] or ""
+
+def list_conversations(preview_len=50, limit=None):
+    """List saved conversations from the index, most recently active first
+
+    With a limit only the most recently active rows are selected and formatted.
+    created/created_display are for display only.
+    """
+    # The background writer may be appending to or compacting the index
+    with _WRITE_LOCK:
+        rows = _read_index().values()
+    if limit is None:
+        rows = sorted(rows, key=_last_active, reverse=True)
+    else:
+        rows = heapq.nlargest(limit, rows, key=_last_active)
+
+    conversations = []
+    for row in rows:
+        preview = row.get("preview") or "New conversation"
+        if len(preview) > preview_len:
+            preview = preview[:preview_len] + "..."
+        # Rows written before created_display existed get it filled in here
+        created_display = row.get("created_display") or _display_time(row["created"])
+        conversations.append(dict(row, preview=preview, created_display=created_display))
+    return conversations